@@ -1,8 +1,20 @@
+import asyncio
+import atexit
+import copy
 import logging
+import logging.handlers
 import os
+import queue
 import re
+import secrets
+import shutil
+import tempfile
+import threading
 import time
 import yt_dlp
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import (
@@ -32,36 +44,77 @@ if telegram.__version__ != "20.6":
 # ==================== CONFIGURACIÓN ADICIONAL ====================
 TEMP_DIR = "temp_downloads"
 MAX_FILE_SIZE = 49 * 1024 * 1024  # 49MB (margen de seguridad)
+MAX_FILE_MB = MAX_FILE_SIZE / 1024 / 1024
 MAX_DOWNLOADS_PER_HOUR = 10
-
-# Rate limiting
-USER_DOWNLOADS = {}
+MAX_DOWNLOAD_WORKERS = min(4, os.cpu_count() or 1)
+
+# Rate limiting (token bucket: user_id -> [tokens, última recarga])
+# Ordenado por última actividad (LRU) y acotado a MAX_TRACKED_USERS
+USER_DOWNLOADS: "OrderedDict[int, list]" = OrderedDict()
+MAX_TRACKED_USERS = 100_000
+REFILL_RATE = MAX_DOWNLOADS_PER_HOUR / 3600  # tokens por segundo
+RATE_LIMIT_SWEEP_INTERVAL = 600
+
+# Caché de metadatos (video_id -> (timestamp, info))
+INFO_CACHE_TTL = 600  # 10 minutos
+INFO_CACHE_MAX = 1024
+VIDEO_ID_RE = re.compile(r'(?:v=|youtu\.be/|/shorts/)([A-Za-z0-9_-]{11})')
+_INFO_CACHE: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+_INFO_CACHE_LOCK = threading.Lock()
+INFO_YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'noplaylist': True,
+    'socket_timeout': 10,
+}
+
+# Callbacks de descarga: token corto -> (timestamp, url), para no exceder
+# el límite de 64 bytes de callback_data de Telegram
+PENDING_TTL = 3600
+_PENDING: dict[str, tuple[float, str]] = {}
+_ACTIONS = {"v": "video", "a": "audio"}
 
 # Configuración de logging
-logging.basicConfig(
-    format='%(asctime)s | %(levelname)-8s | %(name)-15s | %(message)s',
-    level=logging.INFO,
-    handlers=[
+# Los registros se encolan y un hilo aparte los escribe en disco/consola,
+# así el event loop no se bloquea esperando I/O.
+LOG_FORMAT = '%(asctime)s | %(levelname)-8s | %(name)-15s | %(message)s'
+
+def _log_handlers() -> list[logging.Handler]:
+    handlers = [
         logging.FileHandler("bot.log", encoding='utf-8'),
         logging.StreamHandler()
     ]
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    return handlers
+
+_LOG_QUEUE = queue.SimpleQueue()
+logging.basicConfig(
+    format='%(message)s',  # el formato real lo aplican los handlers del listener
+    level=logging.INFO,
+    handlers=[logging.handlers.QueueHandler(_LOG_QUEUE)]
 )
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, *_log_handlers())
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
 logger = logging.getLogger("YouTubeBot")
 
 # ==================== UTILIDADES ====================
+_FN_BAD = re.compile(r'[<>:"/\\|?*]')
+_FN_WS = re.compile(r'\s+')
+_YT_NEEDLES = ("youtube.com", "youtu.be", "youtube-nocookie.com")
+
 def sanitize_filename(filename: str) -> str:
     """Limpia el nombre de archivo de caracteres problemáticos"""
-    filename = re.sub(r'[<>:"/\\|?*]', '', filename)
-    filename = re.sub(r'\s+', '_', filename.strip())
-    return filename[:50] or "video_sin_titulo"
+    return _FN_WS.sub('_', _FN_BAD.sub('', filename).strip())[:50] or "video_sin_titulo"
+
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
 
 def format_size(bytes_size: int) -> str:
     """Convierte bytes a formato legible"""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if bytes_size < 1024:
-            return f"{bytes_size:.1f} {unit}"
-        bytes_size /= 1024
-    return f"{bytes_size:.1f} TB"
+    # bit_length() // 10 == floor(log1024(n)) exacto, sin errores de coma flotante
+    i = 0 if bytes_size < 1 else min((int(bytes_size).bit_length() - 1) // 10, 4)
+    return f"{bytes_size / (1024 ** i):.1f} {_SIZE_UNITS[i]}"
 
 def format_duration(seconds: int) -> str:
     """Convierte segundos a formato legible"""
@@ -75,87 +128,171 @@ def format_duration(seconds: int) -> str:
 
 def is_valid_youtube_url(url: str) -> bool:
     """Valida URL de YouTube (permisivo para aceptar parámetros)"""
-    return 'youtube.com' in url or 'youtu.be' in url or 'youtube-nocookie.com' in url
+    u = url.lower()
+    return any(n in u for n in _YT_NEEDLES)
+
+_YDL_LOCAL = threading.local()
+
+def _get_ydl(opts: dict) -> yt_dlp.YoutubeDL:
+    """Devuelve una instancia de YoutubeDL reutilizable para estas opciones
+
+    Crear un YoutubeDL registra todos los extractores; reutilizarlo evita ese
+    coste en cada petición. YoutubeDL no es thread-safe, así que la caché es
+    por hilo.
+    """
+    cache = getattr(_YDL_LOCAL, 'cache', None)
+    if cache is None:
+        cache = _YDL_LOCAL.cache = {}
+    key = frozenset((k, repr(v)) for k, v in opts.items())
+    ydl = cache.get(key)
+    if ydl is None:
+        # YoutubeDL modifica en sitio el dict de opciones: se le pasa una copia
+        # para que la clave siga siendo válida y cada instancia tenga sus params
+        ydl = yt_dlp.YoutubeDL(copy.deepcopy(opts))
+        cache[key] = ydl
+    return ydl
 
 def extract_video_info(url: str):
-    """Extrae información del video (título, duración, vistas, miniatura)"""
+    """Extrae información del video (título, duración, vistas, miniatura)
+
+    Los resultados se guardan en caché por ID de video durante INFO_CACHE_TTL
+    segundos para evitar repetir la consulta a YouTube en reintentos.
+    Puede ejecutarse desde varios hilos a la vez.
+    """
+    match = VIDEO_ID_RE.search(url)
+    video_id = match.group(1) if match else None
+
+    if video_id:
+        with _INFO_CACHE_LOCK:
+            cached = _INFO_CACHE.get(video_id)
+            if cached and time.monotonic() - cached[0] < INFO_CACHE_TTL:
+                _INFO_CACHE.move_to_end(video_id)
+                return cached[1]
+
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'socket_timeout': 10,
+        ydl = _get_ydl(INFO_YDL_OPTS)
+        # process=False: solo los metadatos del extractor, sin resolver formatos
+        info = ydl.extract_info(url, download=False, process=False)
+        if info.get('_type') == 'url':
+            # p.ej. watch?v=...&list=... con noplaylist → referencia al video
+            info = ydl.extract_info(info['url'], download=False, process=False)
+        thumbnails = info.get('thumbnails') or [{}]
+        video_info = {
+            'title': info.get('title', 'Sin título'),
+            'duration': info.get('duration', 0),
+            'views': info.get('view_count', 0),
+            'uploader': info.get('uploader', 'Desconocido'),
+            'thumbnail': info.get('thumbnail') or thumbnails[-1].get('url', ''),
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return {
-                'title': info.get('title', 'Sin título'),
-                'duration': info.get('duration', 0),
-                'views': info.get('view_count', 0),
-                'uploader': info.get('uploader', 'Desconocido'),
-                'thumbnail': info.get('thumbnail', ''),
-            }
     except Exception as e:
         logger.error(f"Error extrayendo info del video: {e}")
         return None
 
-def check_rate_limit(user_id: int) -> tuple[bool, int]:
-    """Verifica límite de descargas por hora"""
-    now = time.time()
-    if user_id not in USER_DOWNLOADS:
-        USER_DOWNLOADS[user_id] = []
-
-    USER_DOWNLOADS[user_id] = [t for t in USER_DOWNLOADS[user_id] if now - t < 3600]
+    if video_id:
+        with _INFO_CACHE_LOCK:
+            _INFO_CACHE[video_id] = (time.monotonic(), video_info)
+            _INFO_CACHE.move_to_end(video_id)
+            if len(_INFO_CACHE) > INFO_CACHE_MAX:
+                _INFO_CACHE.popitem(last=False)
+    return video_info
 
-    if len(USER_DOWNLOADS[user_id]) >= MAX_DOWNLOADS_PER_HOUR:
-        wait_time = int(3600 - (now - USER_DOWNLOADS[user_id][0]))
-        return False, wait_time
-
-    USER_DOWNLOADS[user_id].append(now)
-    remaining = MAX_DOWNLOADS_PER_HOUR - len(USER_DOWNLOADS[user_id])
-    return True, remaining
+def check_rate_limit(user_id: int) -> tuple[bool, int]:
+    """Verifica límite de descargas por hora (token bucket)
+
+    Devuelve (True, descargas restantes) o (False, segundos de espera).
+    """
+    now = time.monotonic()
+    entry = USER_DOWNLOADS.setdefault(user_id, [MAX_DOWNLOADS_PER_HOUR, now])
+    entry[0] = min(MAX_DOWNLOADS_PER_HOUR, entry[0] + (now - entry[1]) * REFILL_RATE)
+    entry[1] = now
+    USER_DOWNLOADS.move_to_end(user_id)
+    if len(USER_DOWNLOADS) > MAX_TRACKED_USERS:
+        USER_DOWNLOADS.popitem(last=False)
+
+    if entry[0] >= 1:
+        entry[0] -= 1
+        return True, int(entry[0])
+
+    return False, int((1 - entry[0]) / REFILL_RATE)
+
+async def sweep_rate_limits():
+    """Elimina periódicamente usuarios inactivos (con el bucket ya lleno)"""
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SWEEP_INTERVAL)
+        now = time.monotonic()
+        # USER_DOWNLOADS está ordenado por actividad: los inactivos son un prefijo
+        removed = 0
+        while USER_DOWNLOADS:
+            last = next(iter(USER_DOWNLOADS.values()))[1]
+            if now - last < 3600:
+                break
+            USER_DOWNLOADS.popitem(last=False)
+            removed += 1
+        if removed:
+            logger.info(f"🧹 Rate limit: {removed} usuarios inactivos eliminados")
+
+def _sweep_pending(now: float):
+    """Descarta tokens caducados (el dict está ordenado por antigüedad)"""
+    while _PENDING:
+        tok = next(iter(_PENDING))
+        if now - _PENDING[tok][0] < PENDING_TTL:
+            break
+        del _PENDING[tok]
+
+def register_url(url: str) -> str:
+    """Guarda la URL en el servidor y devuelve un token para callback_data"""
+    now = time.monotonic()
+    _sweep_pending(now)
+    tok = secrets.token_urlsafe(6)
+    _PENDING[tok] = (now, url)
+    return tok
+
+def pop_url(tok: str):
+    """Recupera (y consume) la URL asociada a un token, o None si caducó"""
+    _sweep_pending(time.monotonic())
+    return _PENDING.pop(tok, (0, None))[1]
 
 # ==================== FUNCIONES DE DESCARGA (SÍNCRONAS) ====================
-def download_video(url: str, output_dir: str):
-    """Descarga video en mejor calidad (720p) - FUNCIÓN SÍNCRONA"""
-    os.makedirs(output_dir, exist_ok=True)
-
-    ydl_opts = {
+def _abort_if_too_large(d: dict):
+    """Progress hook de yt-dlp: aborta la descarga si el archivo superará el límite"""
+    limit = MAX_FILE_SIZE * 1.3
+    expected = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+    if d.get('downloaded_bytes', 0) > limit or expected > limit:
+        # DownloadCancelled es la forma prevista de detener yt-dlp desde un hook;
+        # los restos parciales se borran junto con el directorio de la descarga
+        raise yt_dlp.utils.DownloadCancelled("file too large")
+
+_DIRS_READY: set[str] = set()
+
+def _ensure_dir(path: str):
+    """Crea el directorio solo la primera vez que se usa en este proceso"""
+    if path not in _DIRS_READY:
+        os.makedirs(path, exist_ok=True)
+        _DIRS_READY.add(path)
+
+def _downloaded_path(ydl, info: dict) -> str:
+    """Ruta final del archivo (yt-dlp la actualiza tras los postprocesadores)"""
+    downloads = info.get('requested_downloads') or [{}]
+    return downloads[0].get('filepath') or ydl.prepare_filename(info)
+
+def video_ydl_opts() -> dict:
+    """Opciones de yt-dlp para descargar MP4 (720p)"""
+    return {
         'format': 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720][ext=mp4]/best',
-        'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
+        'outtmpl': '%(title)s.%(ext)s',
         'noplaylist': True,
         'quiet': True,
         'no_warnings': True,
         'restrictfilenames': True,
         'socket_timeout': 15,
+        'progress_hooks': [_abort_if_too_large],
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        filepath = ydl.prepare_filename(info)
-
-        title = sanitize_filename(info.get('title', 'Sin título'))
-        safe_path = os.path.join(output_dir, f"{title}.mp4")
-
-        if filepath != safe_path:
-            if os.path.exists(safe_path):
-                os.remove(safe_path)
-            try:
-                os.rename(filepath, safe_path)
-                filepath = safe_path
-            except Exception as e:
-                logger.warning(f"Error renombrando archivo: {e}. Usando ruta original.")
-
-        duration = info.get('duration', 0)
-        return filepath, title, duration
-
-def download_audio(url: str, output_dir: str):
-    """Descarga solo el audio en formato MP3 - FUNCIÓN SÍNCRONA"""
-    os.makedirs(output_dir, exist_ok=True)
-
-    ydl_opts = {
+def audio_ydl_opts() -> dict:
+    """Opciones de yt-dlp para extraer MP3 (192kbps)"""
+    return {
         'format': 'bestaudio[ext=m4a]/bestaudio/best',
-        'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
+        'outtmpl': '%(title)s.%(ext)s',
         'postprocessors': [{
             'key': 'FFmpegExtractAudio',
             'preferredcodec': 'mp3',
@@ -166,74 +303,297 @@ def download_audio(url: str, output_dir: str):
         'no_warnings': True,
         'restrictfilenames': True,
         'socket_timeout': 15,
+        'progress_hooks': [_abort_if_too_large],
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        filepath = ydl.prepare_filename(info)
+def _download(url: str, output_dir: str, opts_builder, ext: str):
+    """Descarga con yt-dlp en output_dir y renombra a <título>.<ext>"""
+    ydl = _get_ydl(opts_builder())
+    # El directorio va en 'paths' (no en outtmpl) para reutilizar la misma
+    # instancia. Modificar params de una instancia compartida solo es seguro
+    # porque cada worker del pool ejecuta una descarga a la vez en un único
+    # hilo; si las descargas pasaran a hilos, los directorios se mezclarían.
+    ydl.params['paths'] = {'home': output_dir}
+    info = ydl.extract_info(url, download=True)
+    filepath = _downloaded_path(ydl, info)
+
+    title = sanitize_filename(info.get('title', 'Sin título'))
+    safe_path = os.path.join(output_dir, f"{title}.{ext}")
+
+    if filepath != safe_path:
+        try:
+            os.replace(filepath, safe_path)
+            filepath = safe_path
+        except OSError as e:
+            logger.warning(f"Error renombrando archivo: {e}. Usando ruta original.")
+
+    duration = info.get('duration', 0)
+    return filepath, title, duration
 
-        filepath = str(filepath).replace('.m4a', '.mp3').replace('.webm', '.mp3')
+def download_video(url: str, output_dir: str):
+    """Descarga video en mejor calidad (720p) - FUNCIÓN SÍNCRONA"""
+    return _download(url, output_dir, video_ydl_opts, "mp4")
 
-        title = sanitize_filename(info.get('title', 'Sin título'))
-        safe_path = os.path.join(output_dir, f"{title}.mp3")
+def download_audio(url: str, output_dir: str):
+    """Descarga solo el audio en formato MP3 - FUNCIÓN SÍNCRONA"""
+    return _download(url, output_dir, audio_ydl_opts, "mp3")
+
+# ==================== POOL DE DESCARGAS ====================
+# Las descargas (yt-dlp + ffmpeg) se ejecutan en procesos aparte para no
+# bloquear el event loop mientras se atienden otros usuarios.
+def _init_download_worker():
+    """Los procesos hijos no tienen el hilo del QueueListener: escriben directamente"""
+    root = logging.getLogger()
+    root.handlers = _log_handlers()
+    # Precalentar instancias de YoutubeDL para que la primera descarga no pague el arranque
+    _get_ydl(video_ydl_opts())
+    _get_ydl(audio_ydl_opts())
+
+def _new_download_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=MAX_DOWNLOAD_WORKERS,
+        initializer=_init_download_worker
+    )
 
-        if filepath != safe_path:
-            if os.path.exists(safe_path):
-                os.remove(safe_path)
-            try:
-                os.rename(filepath, safe_path)
-                filepath = safe_path
-            except Exception as e:
-                logger.warning(f"Error renombrando archivo: {e}. Usando ruta original.")
+def _warm_up_worker():
+    """Tarea vacía: solo fuerza el arranque de los workers (y su initializer)"""
+
+def _log_warm_up(future):
+    if not future.cancelled() and future.exception():
+        logger.error(f"Error arrancando los workers de descarga: {future.exception()}")
+
+DOWNLOAD_POOL = _new_download_pool()
+_DOWNLOAD_SLOTS = asyncio.Semaphore(MAX_DOWNLOAD_WORKERS)
+
+async def run_download(func, url: str, output_dir: str):
+    """Ejecuta una función de descarga en el pool, limitando las que esperan en cola"""
+    global DOWNLOAD_POOL
+    async with _DOWNLOAD_SLOTS:
+        loop = asyncio.get_running_loop()
+        pool = DOWNLOAD_POOL
+        try:
+            return await loop.run_in_executor(pool, func, url, output_dir)
+        except BrokenProcessPool as e:
+            # Un worker murió (OOM en ffmpeg, segfault...) y el pool queda
+            # inutilizable: se recrea una sola vez aunque fallen varias descargas
+            if DOWNLOAD_POOL is pool:
+                logger.error("Pool de descargas roto, recreándolo")
+                DOWNLOAD_POOL = _new_download_pool()
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise RuntimeError("El proceso de descarga terminó inesperadamente") from e
+
+# ==================== MENSAJES ====================
+WELCOME_MSG = (
+    "🎬 <b>YouTube Downloader Bot</b>\n\n"
+    "¡Hola! 👋 Soy tu asistente para descargar contenido de YouTube de forma rápida y sencilla.\n\n"
+    "✅ <b>¿Qué puedo hacer por ti?</b>\n"
+    "   • Descargar videos en formato MP4 (hasta 720p)\n"
+    "   • Extraer audio en formato MP3 de alta calidad\n"
+    "   • Procesar enlaces de YouTube, Shorts y enlaces cortos\n\n"
+    "📌 <b>Instrucciones de uso:</b>\n"
+    "   1️⃣ Envía cualquier enlace de YouTube\n"
+    "   2️⃣ Selecciona el formato deseado (MP4 o MP3)\n"
+    "   3️⃣ ¡Recibe tu archivo en segundos!\n\n"
+    "⚠️ <b>Importante:</b>\n"
+    "   • Límite: 10 descargas por hora\n"
+    "   • Tamaño máximo: 49MB (~8-10 min en 720p)\n"
+    "   • Solo para uso personal y legal\n"
+    "   • Respeta los derechos de autor\n\n"
+    "✨ <i>¡Listo para empezar? ¡Envía tu primer enlace!</i>"
+)
 
-        duration = info.get('duration', 0)
-        return filepath, title, duration
+ABOUT_MSG = (
+    "ℹ️ <b>Acerca de YouTube Downloader Bot</b>\n\n"
+    "🤖 <b>Versión:</b> 2.0\n"
+    "⚡ <b>Características:</b>\n"
+    "   • Descarga rápida de videos y audio\n"
+    "   • Soporte para todos los formatos de YouTube\n"
+    "   • Límite de tamaño inteligente (49MB)\n"
+    "   • Sistema de rate limiting integrado\n"
+    "   • Limpieza automática de archivos temporales\n\n"
+    "🔒 <b>Seguridad:</b>\n"
+    "   • Archivos eliminados inmediatamente después de enviar\n"
+    "   • Sin almacenamiento permanente de contenido\n"
+    "   • Cumple con políticas de Telegram\n\n"
+    "👨‍💻 <b>Desarrollado con:</b>\n"
+    "   • Python 3.10+\n"
+    "   • python-telegram-bot 20.6\n"
+    "   • yt-dlp\n"
+    "   • FFmpeg (para conversión de audio)\n\n"
+    "💡 <i>Este bot es de código abierto y para uso educativo/personal.</i>"
+)
 
-# ==================== MANEJADORES ====================
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Mensaje de bienvenida profesional con instrucciones claras"""
-    welcome_msg = (
-        "🎬 <b>YouTube Downloader Bot</b>\n\n"
-        "¡Hola! 👋 Soy tu asistente para descargar contenido de YouTube de forma rápida y sencilla.\n\n"
-        "✅ <b>¿Qué puedo hacer por ti?</b>\n"
-        "   • Descargar videos en formato MP4 (hasta 720p)\n"
-        "   • Extraer audio en formato MP3 de alta calidad\n"
-        "   • Procesar enlaces de YouTube, Shorts y enlaces cortos\n\n"
-        "📌 <b>Instrucciones de uso:</b>\n"
-        "   1️⃣ Envía cualquier enlace de YouTube\n"
-        "   2️⃣ Selecciona el formato deseado (MP4 o MP3)\n"
-        "   3️⃣ ¡Recibe tu archivo en segundos!\n\n"
-        "⚠️ <b>Importante:</b>\n"
-        "   • Límite: 10 descargas por hora\n"
-        "   • Tamaño máximo: 49MB (~8-10 min en 720p)\n"
-        "   • Solo para uso personal y legal\n"
-        "   • Respeta los derechos de autor\n\n"
-        "✨ <i>¡Listo para empezar? ¡Envía tu primer enlace!</i>"
-    )
+TERMS_MSG = (
+    "⚖️ <b>Términos de Uso</b>\n\n"
+    "Al utilizar este bot, aceptas los siguientes términos:\n\n"
+    "✅ <b>Uso Permitido:</b>\n"
+    "   • Descargar tus propios videos\n"
+    "   • Contenido con licencia Creative Commons\n"
+    "   • Material de dominio público\n"
+    "   • Contenido con permiso explícito del creador\n\n"
+    "❌ <b>Uso Prohibido:</b>\n"
+    "   • Descargar contenido con copyright sin permiso\n"
+    "   • Distribuir material protegido ilegalmente\n"
+    "   • Usar el bot para actividades comerciales masivas\n"
+    "   • Evadir sistemas de protección de derechos\n\n"
+    "⚠️ <b>Responsabilidad:</b>\n"
+    "   • Eres responsable legal del contenido que descargas\n"
+    "   • El desarrollador no se hace responsable del mal uso\n"
+    "   • YouTube y Telegram son marcas registradas\n"
+    "   • Este bot no está afiliado a Google/YouTube/Telegram\n\n"
+    "💡 <i>Al continuar usando el bot, aceptas estos términos.</i>"
+)
 
-    keyboard = [
-        [
-            InlineKeyboardButton("ℹ️ Acerca de", callback_data="about"),
-            InlineKeyboardButton("⚖️ Términos", callback_data="terms")
-        ],
-        [
-            InlineKeyboardButton("✅ Empezar ahora", callback_data="help_start")
-        ]
+HELP_START_MSG = (
+    "🚀 <b>Guía Rápida de Inicio</b>\n\n"
+    "Sigue estos 3 simples pasos:\n\n"
+    "❶ <b>Envía un enlace de YouTube</b>\n"
+    "   Ejemplos válidos:\n"
+    "   • <code>https://youtu.be/dQw4w9WgXcQ</code>\n"
+    "   • <code>https://www.youtube.com/watch?v=XUoXE3bmDJY</code>\n"
+    "   • <code>https://youtube.com/shorts/abc123</code>\n\n"
+    "❷ <b>Selecciona el formato</b>\n"
+    "   • 🎥 <b>MP4</b> - Video con audio (hasta 720p)\n"
+    "   • 🎵 <b>MP3</b> - Solo audio (192kbps)\n\n"
+    "❸ <b>Recibe tu archivo</b>\n"
+    "   • El archivo se enviará en segundos\n"
+    "   • Se elimina automáticamente del servidor\n\n"
+    "⚠️ <b>Límites:</b>\n"
+    "   • Máximo 10 descargas por hora\n"
+    "   • Tamaño máximo: 49MB\n\n"
+    "💡 <i>¡Listo! Envía tu primer enlace para comenzar.</i>"
+)
+
+HELP_MSG = (
+    "🚀 <b>Guía Rápida de Inicio</b>\n\n"
+    "Envía un enlace de YouTube y elige MP4 o MP3.\n\n"
+    "✅ Ejemplos:\n"
+    "• <code>https://youtu.be/VIDEO_ID</code>\n"
+    "• <code>https://www.youtube.com/watch?v=VIDEO_ID</code>\n"
+    "• <code>https://youtube.com/shorts/VIDEO_ID</code>\n\n"
+    "⚠️ Límite: 10 descargas/hora | Tamaño máx: 49MB\n"
+)
+
+ABOUT_SHORT_MSG = (
+    "ℹ️ <b>Acerca de</b>\n\n"
+    "🤖 YouTube Downloader Bot v2.0\n"
+    "✅ MP4 (hasta 720p)\n"
+    "✅ MP3 (192kbps)\n"
+    "🔧 python-telegram-bot 20.6 + yt-dlp\n"
+)
+
+INVALID_URL_MSG = (
+    "❌ <b>URL no reconocida</b>\n\n"
+    "Por favor, envía un enlace válido de YouTube:\n\n"
+    "✅ <b>Ejemplos válidos:</b>\n"
+    "   • <code>https://youtu.be/VIDEO_ID</code>\n"
+    "   • <code>https://www.youtube.com/watch?v=VIDEO_ID</code>\n"
+    "   • <code>https://youtube.com/shorts/VIDEO_ID</code>\n"
+)
+
+ANALYZING_MSG = (
+    "🔍 <b>Analizando enlace...</b>\n\nExtrayendo información del video...\n\n"
+    "👇 <b>Ya puedes elegir el formato:</b>"
+)
+
+CANCEL_MSG = "❌ <b>Operación cancelada</b>\n\nPuedes enviar otro enlace cuando quieras."
+INVALID_REQUEST_MSG = "❌ <b>Error en la solicitud</b>\n\nDatos inválidos. Envía el enlace nuevamente."
+
+VIDEO_STATUS_MSG = "⏬ <b>Descargando video...</b>\n\n🎥 Formato: MP4 (720p)\n⏱ Por favor espera..."
+AUDIO_STATUS_MSG = "⏬ <b>Extrayendo audio...</b>\n\n🎵 Formato: MP3 (192kbps)\n⏱ Por favor espera..."
+
+DONE_MSG = (
+    "🎉 <b>¡Descarga completada con éxito!</b>\n\n"
+    "✅ Tu archivo ha sido enviado.\n"
+    "🧹 El archivo se eliminó automáticamente del servidor.\n\n"
+    "¿Quieres descargar otro video?"
+)
+
+ERR_RESTRICTED_MSG = (
+    "🔒 <b>Video privado o restringido</b>\n\n"
+    "YouTube no permite descargar este contenido (privado/edad/login).\n"
+    "💡 <i>Usa un video público sin restricciones.</i>"
+)
+
+ERR_COPYRIGHT_MSG = (
+    "©️ <b>Restricciones de copyright</b>\n\n"
+    "El video tiene protección o restricción.\n"
+    "💡 <i>Intenta con otro video.</i>"
+)
+
+ERR_FFMPEG_MSG = (
+    "🔧 <b>Error de conversión</b>\n\n"
+    "FFmpeg no está instalado o configurado correctamente.\n"
+    "💡 <i>Instala FFmpeg en el servidor/PC.</i>"
+)
+
+ERR_TIMEOUT_MSG = (
+    "⏱ <b>Tiempo de espera agotado</b>\n\n"
+    "YouTube no respondió a tiempo.\n"
+    "💡 <i>Intenta nuevamente en unos minutos.</i>"
+)
+
+ERR_TOO_LARGE_MSG = (
+    f"📦 <b>Archivo demasiado grande</b>\n\n"
+    f"El archivo excede el límite de {format_size(MAX_FILE_SIZE)}.\n"
+    "💡 <i>Usa un video más corto o descarga MP3.</i>"
+)
+
+# Clasificación de errores: categoría -> palabras clave, en orden de prioridad
+_ERR_CATEGORIES = (
+    ("restricted", ("private", "sign in", "age")),
+    ("copyright", ("copyright", "blocked", "unavailable")),
+    ("ffmpeg", ("ffmpeg", "ffprobe")),
+    ("timeout", ("timed out", "timeout", "socket")),
+    ("too_large", ("file too large", "49mb", "50mb")),
+)
+_ERR_MAP = {kw: cat for cat, kws in _ERR_CATEGORIES for kw in kws}
+_ERR_PRIORITY = {cat: i for i, (cat, _) in enumerate(_ERR_CATEGORIES)}
+_ERR_RE = re.compile("|".join(re.escape(kw) for kw in sorted(_ERR_MAP, key=len, reverse=True)))
+_ERR_TEMPLATES = {
+    "restricted": ERR_RESTRICTED_MSG,
+    "copyright": ERR_COPYRIGHT_MSG,
+    "ffmpeg": ERR_FFMPEG_MSG,
+    "timeout": ERR_TIMEOUT_MSG,
+    "too_large": ERR_TOO_LARGE_MSG,
+}
+
+def classify_error(error: str):
+    """Devuelve la categoría del error (una sola pasada) o None si no se reconoce"""
+    hits = {_ERR_MAP[m.group(0)] for m in _ERR_RE.finditer(error.lower())}
+    return min(hits, key=_ERR_PRIORITY.__getitem__) if hits else None
+
+# Teclados fijos (se construyen una sola vez)
+START_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("ℹ️ Acerca de", callback_data="about"),
+        InlineKeyboardButton("⚖️ Términos", callback_data="terms")
+    ],
+    [
+        InlineKeyboardButton("✅ Empezar ahora", callback_data="help_start")
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+])
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Volver al inicio", callback_data="start")]])
+DONE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Descargar otro", callback_data="start")],
+    [InlineKeyboardButton("ℹ️ Ayuda", callback_data="help_start")]
+])
 
+# ==================== MANEJADORES ====================
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mensaje de bienvenida profesional con instrucciones claras"""
     if update.message:
         await update.message.reply_text(
-            welcome_msg,
+            WELCOME_MSG,
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=START_MARKUP
         )
     else:
         query = update.callback_query
         await query.edit_message_text(
-            welcome_msg,
+            WELCOME_MSG,
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=START_MARKUP
         )
 
 async def about_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -241,34 +601,10 @@ async def about_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    about_msg = (
-        "ℹ️ <b>Acerca de YouTube Downloader Bot</b>\n\n"
-        "🤖 <b>Versión:</b> 2.0\n"
-        "⚡ <b>Características:</b>\n"
-        "   • Descarga rápida de videos y audio\n"
-        "   • Soporte para todos los formatos de YouTube\n"
-        "   • Límite de tamaño inteligente (49MB)\n"
-        "   • Sistema de rate limiting integrado\n"
-        "   • Limpieza automática de archivos temporales\n\n"
-        "🔒 <b>Seguridad:</b>\n"
-        "   • Archivos eliminados inmediatamente después de enviar\n"
-        "   • Sin almacenamiento permanente de contenido\n"
-        "   • Cumple con políticas de Telegram\n\n"
-        "👨‍💻 <b>Desarrollado con:</b>\n"
-        "   • Python 3.10+\n"
-        "   • python-telegram-bot 20.6\n"
-        "   • yt-dlp\n"
-        "   • FFmpeg (para conversión de audio)\n\n"
-        "💡 <i>Este bot es de código abierto y para uso educativo/personal.</i>"
-    )
-
-    keyboard = [[InlineKeyboardButton("⬅️ Volver al inicio", callback_data="start")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
-        about_msg,
+        ABOUT_MSG,
         parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
+        reply_markup=BACK_MARKUP
     )
 
 async def terms_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -276,34 +612,10 @@ async def terms_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    terms_msg = (
-        "⚖️ <b>Términos de Uso</b>\n\n"
-        "Al utilizar este bot, aceptas los siguientes términos:\n\n"
-        "✅ <b>Uso Permitido:</b>\n"
-        "   • Descargar tus propios videos\n"
-        "   • Contenido con licencia Creative Commons\n"
-        "   • Material de dominio público\n"
-        "   • Contenido con permiso explícito del creador\n\n"
-        "❌ <b>Uso Prohibido:</b>\n"
-        "   • Descargar contenido con copyright sin permiso\n"
-        "   • Distribuir material protegido ilegalmente\n"
-        "   • Usar el bot para actividades comerciales masivas\n"
-        "   • Evadir sistemas de protección de derechos\n\n"
-        "⚠️ <b>Responsabilidad:</b>\n"
-        "   • Eres responsable legal del contenido que descargas\n"
-        "   • El desarrollador no se hace responsable del mal uso\n"
-        "   • YouTube y Telegram son marcas registradas\n"
-        "   • Este bot no está afiliado a Google/YouTube/Telegram\n\n"
-        "💡 <i>Al continuar usando el bot, aceptas estos términos.</i>"
-    )
-
-    keyboard = [[InlineKeyboardButton("⬅️ Volver al inicio", callback_data="start")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
-        terms_msg,
+        TERMS_MSG,
         parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
+        reply_markup=BACK_MARKUP
     )
 
 async def help_start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -311,72 +623,41 @@ async def help_start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
 
-    help_msg = (
-        "🚀 <b>Guía Rápida de Inicio</b>\n\n"
-        "Sigue estos 3 simples pasos:\n\n"
-        "❶ <b>Envía un enlace de YouTube</b>\n"
-        "   Ejemplos válidos:\n"
-        "   • <code>https://youtu.be/dQw4w9WgXcQ</code>\n"
-        "   • <code>https://www.youtube.com/watch?v=XUoXE3bmDJY</code>\n"
-        "   • <code>https://youtube.com/shorts/abc123</code>\n\n"
-        "❷ <b>Selecciona el formato</b>\n"
-        "   • 🎥 <b>MP4</b> - Video con audio (hasta 720p)\n"
-        "   • 🎵 <b>MP3</b> - Solo audio (192kbps)\n\n"
-        "❸ <b>Recibe tu archivo</b>\n"
-        "   • El archivo se enviará en segundos\n"
-        "   • Se elimina automáticamente del servidor\n\n"
-        "⚠️ <b>Límites:</b>\n"
-        "   • Máximo 10 descargas por hora\n"
-        "   • Tamaño máximo: 49MB\n\n"
-        "💡 <i>¡Listo! Envía tu primer enlace para comenzar.</i>"
-    )
-
-    keyboard = [[InlineKeyboardButton("⬅️ Volver al inicio", callback_data="start")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
-        help_msg,
+        HELP_START_MSG,
         parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
+        reply_markup=BACK_MARKUP
     )
 
+async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancela la operación en curso (para callback)
+
+    El token del botón ya lo consume button_handler antes de llegar aquí.
+    """
+    await update.callback_query.edit_message_text(CANCEL_MSG, parse_mode=ParseMode.HTML)
+
+# Callbacks fijos → manejador
+_CALLBACKS = {
+    "start": start,
+    "about": about_handler,
+    "terms": terms_handler,
+    "help_start": help_start_handler,
+    "cancel": cancel_handler,
+}
+
 # ✅ WRAPPERS PARA COMANDOS (cambios mínimos)
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_msg = (
-        "🚀 <b>Guía Rápida de Inicio</b>\n\n"
-        "Envía un enlace de YouTube y elige MP4 o MP3.\n\n"
-        "✅ Ejemplos:\n"
-        "• <code>https://youtu.be/VIDEO_ID</code>\n"
-        "• <code>https://www.youtube.com/watch?v=VIDEO_ID</code>\n"
-        "• <code>https://youtube.com/shorts/VIDEO_ID</code>\n\n"
-        "⚠️ Límite: 10 descargas/hora | Tamaño máx: 49MB\n"
-    )
-    await update.message.reply_text(help_msg, parse_mode=ParseMode.HTML)
+    await update.message.reply_text(HELP_MSG, parse_mode=ParseMode.HTML)
 
 async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    about_msg = (
-        "ℹ️ <b>Acerca de</b>\n\n"
-        "🤖 YouTube Downloader Bot v2.0\n"
-        "✅ MP4 (hasta 720p)\n"
-        "✅ MP3 (192kbps)\n"
-        "🔧 python-telegram-bot 20.6 + yt-dlp\n"
-    )
-    await update.message.reply_text(about_msg, parse_mode=ParseMode.HTML)
+    await update.message.reply_text(ABOUT_SHORT_MSG, parse_mode=ParseMode.HTML)
 
 async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Procesa URLs de YouTube y muestra opciones de descarga"""
     url = update.message.text.strip()
 
     if not is_valid_youtube_url(url):
-        error_msg = (
-            "❌ <b>URL no reconocida</b>\n\n"
-            "Por favor, envía un enlace válido de YouTube:\n\n"
-            "✅ <b>Ejemplos válidos:</b>\n"
-            "   • <code>https://youtu.be/VIDEO_ID</code>\n"
-            "   • <code>https://www.youtube.com/watch?v=VIDEO_ID</code>\n"
-            "   • <code>https://youtube.com/shorts/VIDEO_ID</code>\n"
-        )
-        await update.message.reply_text(error_msg, parse_mode=ParseMode.HTML)
+        await update.message.reply_text(INVALID_URL_MSG, parse_mode=ParseMode.HTML)
         return
 
     allowed, info = check_rate_limit(update.effective_user.id)
@@ -391,20 +672,32 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(wait_msg, parse_mode=ParseMode.HTML)
         return
 
-    processing_msg = await update.message.reply_text(
-        "🔍 <b>Analizando enlace...</b>\n\nExtrayendo información del video...",
-        parse_mode=ParseMode.HTML
-    )
-
-    video_info = extract_video_info(url)
+    # La consulta de metadatos corre en un hilo mientras el usuario ya ve los botones
+    info_task = asyncio.get_running_loop().run_in_executor(None, extract_video_info, url)
 
+    tok = register_url(url)
     keyboard = [
-        [InlineKeyboardButton("🎬 Descargar MP4 (720p)", callback_data=f"video|{url}")],
-        [InlineKeyboardButton("🎵 Extraer MP3 (192kbps)", callback_data=f"audio|{url}")],
-        [InlineKeyboardButton("⬅️ Cancelar", callback_data="cancel")],
+        [InlineKeyboardButton("🎬 Descargar MP4 (720p)", callback_data=f"v:{tok}")],
+        [InlineKeyboardButton("🎵 Extraer MP3 (192kbps)", callback_data=f"a:{tok}")],
+        [InlineKeyboardButton("⬅️ Cancelar", callback_data=f"cancel:{tok}")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
+    try:
+        processing_msg = await update.message.reply_text(
+            ANALYZING_MSG, parse_mode=ParseMode.HTML, reply_markup=reply_markup
+        )
+    finally:
+        # Esperar siempre al probe, aunque falle el envío, para no dejar el
+        # future sin recoger
+        video_info = await info_task
+
+    # Si el usuario ya eligió una opción, no pisar su mensaje. Solo puede
+    # ocurrir porque la aplicación usa concurrent_updates(True) (ver main());
+    # con updates secuenciales el clic esperaría a que termine este handler.
+    if tok not in _PENDING:
+        return
+
     if video_info:
         title = sanitize_filename(video_info['title'])
         duration_str = format_duration(video_info['duration'])
@@ -435,59 +728,43 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja los callbacks de los botones"""
     query = update.callback_query
+    prefix, _, tok = query.data.partition(":")
+    # Consumir el token antes del primer await: handle_url comprueba _PENDING
+    # para no volver a mostrar los botones sobre la elección del usuario
+    url = pop_url(tok) if tok else None
     await query.answer()
 
-    if query.data == "start":
-        await start(update, context)
-        return
-    elif query.data == "about":
-        await about_handler(update, context)
-        return
-    elif query.data == "terms":
-        await terms_handler(update, context)
-        return
-    elif query.data == "help_start":
-        await help_start_handler(update, context)
-        return
-    elif query.data == "cancel":
-        await query.edit_message_text(
-            "❌ <b>Operación cancelada</b>\n\nPuedes enviar otro enlace cuando quieras.",
-            parse_mode=ParseMode.HTML
-        )
+    handler = _CALLBACKS.get(prefix)
+    if handler:
+        await handler(update, context)
         return
 
-    data = query.data.split("|", 1)
-    if len(data) != 2:
-        await query.edit_message_text(
-            "❌ <b>Error en la solicitud</b>\n\nDatos inválidos. Envía el enlace nuevamente.",
-            parse_mode=ParseMode.HTML
-        )
+    action = _ACTIONS.get(prefix)
+    if action is None or url is None:
+        await query.edit_message_text(INVALID_REQUEST_MSG, parse_mode=ParseMode.HTML)
         return
 
-    action, url = data
-
-    status_msg = (
-        "⏬ <b>Descargando video...</b>\n\n🎥 Formato: MP4 (720p)\n⏱ Por favor espera..."
-        if action == "video"
-        else "⏬ <b>Extrayendo audio...</b>\n\n🎵 Formato: MP3 (192kbps)\n⏱ Por favor espera..."
-    )
+    status_msg = VIDEO_STATUS_MSG if action == "video" else AUDIO_STATUS_MSG
     await query.edit_message_text(status_msg, parse_mode=ParseMode.HTML)
 
-    filepath = None
+    job_dir = None
     try:
+        # Directorio propio por descarga: evita choques entre descargas
+        # simultáneas del mismo video o de títulos iguales
+        _ensure_dir(TEMP_DIR)
+        job_dir = tempfile.mkdtemp(dir=TEMP_DIR)
         if action == "video":
-            filepath, title, duration = download_video(url, TEMP_DIR)
+            filepath, title, duration = await run_download(download_video, url, job_dir)
             file_type = "video"
         else:
-            filepath, title, duration = download_audio(url, TEMP_DIR)
+            filepath, title, duration = await run_download(download_audio, url, job_dir)
             file_type = "audio"
 
-        file_size = os.path.getsize(filepath)
+        file_size = os.stat(filepath).st_size
         if file_size > MAX_FILE_SIZE:
             size_mb = file_size / 1024 / 1024
-            max_mb = MAX_FILE_SIZE / 1024 / 1024
             raise Exception(
-                f"El archivo ({size_mb:.1f}MB) excede el límite de {max_mb:.0f}MB.\n"
+                f"El archivo ({size_mb:.1f}MB) excede el límite de {MAX_FILE_MB:.0f}MB.\n"
                 f"Videos mayores a ~10 minutos en 720p suelen superar este límite."
             )
 
@@ -515,55 +792,16 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode=ParseMode.HTML
                 )
 
-        keyboard = [
-            [InlineKeyboardButton("🔄 Descargar otro", callback_data="start")],
-            [InlineKeyboardButton("ℹ️ Ayuda", callback_data="help_start")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
         await query.message.reply_text(
-            "🎉 <b>¡Descarga completada con éxito!</b>\n\n"
-            "✅ Tu archivo ha sido enviado.\n"
-            "🧹 El archivo se eliminó automáticamente del servidor.\n\n"
-            "¿Quieres descargar otro video?",
+            DONE_MSG,
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=DONE_MARKUP
         )
 
     except Exception as e:
-        error_msg = str(e).lower()
-        user_msg = "❌ <b>Error durante la descarga</b>\n\nOcurrió un problema inesperado."
-
-        if any(x in error_msg for x in ["private", "sign in", "age", "confirm your age"]):
-            user_msg = (
-                "🔒 <b>Video privado o restringido</b>\n\n"
-                "YouTube no permite descargar este contenido (privado/edad/login).\n"
-                "💡 <i>Usa un video público sin restricciones.</i>"
-            )
-        elif any(x in error_msg for x in ["copyright", "blocked", "unavailable"]):
-            user_msg = (
-                "©️ <b>Restricciones de copyright</b>\n\n"
-                "El video tiene protección o restricción.\n"
-                "💡 <i>Intenta con otro video.</i>"
-            )
-        elif "ffmpeg" in error_msg or "ffprobe" in error_msg:
-            user_msg = (
-                "🔧 <b>Error de conversión</b>\n\n"
-                "FFmpeg no está instalado o configurado correctamente.\n"
-                "💡 <i>Instala FFmpeg en el servidor/PC.</i>"
-            )
-        elif "timed out" in error_msg or "timeout" in error_msg or "socket" in error_msg:
-            user_msg = (
-                "⏱ <b>Tiempo de espera agotado</b>\n\n"
-                "YouTube no respondió a tiempo.\n"
-                "💡 <i>Intenta nuevamente en unos minutos.</i>"
-            )
-        elif "file too large" in error_msg or "49mb" in error_msg or "50mb" in error_msg:
-            user_msg = (
-                f"📦 <b>Archivo demasiado grande</b>\n\n"
-                f"El archivo excede el límite de {format_size(MAX_FILE_SIZE)}.\n"
-                "💡 <i>Usa un video más corto o descarga MP3.</i>"
-            )
+        category = classify_error(str(e))
+        if category:
+            user_msg = _ERR_TEMPLATES[category]
         else:
             user_msg = (
                 "❌ <b>Error durante la descarga</b>\n\n"
@@ -572,7 +810,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
         keyboard = [
-            [InlineKeyboardButton("🔄 Intentar nuevamente", callback_data=f"{action}|{url}")],
+            [InlineKeyboardButton("🔄 Intentar nuevamente", callback_data=f"{prefix}:{register_url(url)}")],
             [InlineKeyboardButton("⬅️ Volver al inicio", callback_data="start")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -586,12 +824,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error descargando {url} para usuario {update.effective_user.id}: {e}")
 
     finally:
-        if filepath and os.path.exists(filepath):
+        # Borra el archivo final y cualquier resto parcial (.part, fragmentos)
+        if job_dir:
             try:
-                os.remove(filepath)
-                logger.info(f"🧹 Archivo temporal eliminado: {os.path.basename(filepath)}")
+                shutil.rmtree(job_dir)
+                logger.info(f"🧹 Directorio temporal eliminado: {os.path.basename(job_dir)}")
             except Exception as e:
-                logger.warning(f"No se pudo eliminar {filepath}: {e}")
+                logger.warning(f"No se pudo eliminar {job_dir}: {e}")
 
 # ==================== INICIALIZACIÓN ====================
 async def post_init(app: Application):
@@ -602,6 +841,16 @@ async def post_init(app: Application):
         BotCommand("about", "ℹ️ Información sobre el bot"),
     ]
     await app.bot.set_my_commands(commands)
+    # Guardar referencia para que la tarea no sea recolectada por el GC
+    app.bot_data["rate_limit_sweeper"] = asyncio.create_task(sweep_rate_limits())
+    # Arrancar los workers de descarga ya (su initializer precalienta yt-dlp)
+    DOWNLOAD_POOL.submit(_warm_up_worker).add_done_callback(_log_warm_up)
+
+async def post_shutdown(app: Application):
+    sweeper = app.bot_data.pop("rate_limit_sweeper", None)
+    if sweeper:
+        sweeper.cancel()
+    DOWNLOAD_POOL.shutdown(wait=False, cancel_futures=True)
 
 def main():
     os.makedirs(TEMP_DIR, exist_ok=True)
@@ -615,7 +864,16 @@ def main():
         return
 
     try:
-        application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            # Procesar updates en paralelo: sin esto PTB atiende uno a la vez y
+            # una descarga bloquea los mensajes del resto de usuarios
+            .concurrent_updates(True)
+            .build()
+        )
     except Exception as e:
         print("\n" + "=" * 70)
         print("❌ ERROR AL INICIAR EL BOT")